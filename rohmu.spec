@@ -15,6 +15,7 @@ Requires:       python3-pydantic
 Requires:       python3-requests
 Requires:       python3-snappy
 Requires:       python3-zstandard
+Recommends:     python3-orjson
 BuildRequires:  python3-devel
 BuildRequires:  python3-flake8
 BuildRequires:  python3-pylint
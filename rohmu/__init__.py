@@ -25,6 +25,7 @@ from rohmu.object_storage.base import BaseTransfer
 from rohmu.object_storage.config import (
     AzureObjectStorageConfig,
     GoogleObjectStorageConfig,
+    LocalHashAlgorithm,
     LocalObjectStorageConfig,
     ProxyInfo,
     S3AddressingStyle,
@@ -48,6 +49,7 @@ __all__ = [
     "GoogleObjectStorageConfig",
     "InvalidConfigurationError",
     "IO_BLOCK_SIZE",
+    "LocalHashAlgorithm",
     "LocalObjectStorageConfig",
     "NOTIFIER_TYPE",
     "Notifier",
@@ -218,8 +218,8 @@ class BaseTransfer(Generic[StorageModelT]):
         raise NotImplementedError
 
     def _validate_byte_range(self, byte_range: Optional[Tuple[int, int]]) -> None:
-        if byte_range is not None and byte_range[0] > byte_range[1]:
-            raise InvalidByteRangeError(f"Invalid byte_range: {byte_range}. Start must be <= end.")
+        if byte_range is not None and not 0 <= byte_range[0] <= byte_range[1]:
+            raise InvalidByteRangeError(f"Invalid byte_range: {byte_range}. Start must be >= 0 and <= end.")
 
     def get_contents_to_string(self, key: str, *, byte_range: Optional[Tuple[int, int]] = None) -> tuple[bytes, Metadata]:
         """Returns a tuple (content-byte-string, metadata).
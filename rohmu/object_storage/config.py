@@ -14,7 +14,10 @@ from pydantic import Field, root_validator
 from rohmu.common.models import ProxyInfo, StorageDriver, StorageModel
 from typing import Any, Dict, Final, Literal, Optional, TypeVar
 
+import functools
+import hashlib
 import platform
+import sys
 
 StorageModelT = TypeVar("StorageModelT", bound=StorageModel)
 
@@ -99,10 +102,53 @@ class GoogleObjectStorageConfig(StorageModel):
     storage_type: Literal[StorageDriver.google] = StorageDriver.google
 
 
+@unique
+class LocalHashAlgorithm(Enum):
+    sha256 = "sha256"
+    # SHA-256 over the concatenated SHA-256 digests of each 1 MiB block, the blocks are hashed in parallel
+    sha256_tree_1m = "sha256-tree-1m"
+    sha512_256 = "sha512-256"
+    # resolved to the fastest of the above plain hashes for the current CPU, see calculate_local_hash_algorithm()
+    auto = "auto"
+
+
+def get_cpu_flags() -> frozenset[str]:
+    """Return the CPU feature flags reported by the kernel (or an empty set if they are not available)"""
+    if platform.system() != "Linux":
+        return frozenset()
+
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as in_file:
+            for line in in_file:
+                name, _, value = line.partition(":")
+                # x86 lists "flags", ARM lists "Features"
+                if name.strip() in {"flags", "Features"}:
+                    return frozenset(value.split())
+    except OSError:
+        pass
+
+    return frozenset()
+
+
+@functools.lru_cache(maxsize=None)
+def calculate_local_hash_algorithm() -> LocalHashAlgorithm:
+    """Return the fastest hash algorithm for the current CPU.
+
+    SHA-256 is fastest with the SHA instruction set extensions (sha_ni on x86, sha2 on ARM), without them
+    SHA-512 based hashes are faster on 64-bit CPUs as they process twice the data per round."""
+    has_sha_extensions = bool({"sha_ni", "sha2"} & get_cpu_flags()) or (
+        platform.system() == "Darwin" and platform.machine() == "arm64"
+    )
+    if not has_sha_extensions and sys.maxsize > 2**32 and "sha512_256" in hashlib.algorithms_available:
+        return LocalHashAlgorithm.sha512_256
+    return LocalHashAlgorithm.sha256
+
+
 class LocalObjectStorageConfig(StorageModel):
     # Don't use pydantic DirectoryPath, that class checks the dir exists at the wrong time
     directory: Path
     prefix: Optional[str] = None
+    hash_algorithm: LocalHashAlgorithm = LocalHashAlgorithm.sha256
     storage_type: Literal[StorageDriver.local] = StorageDriver.local
 
 
@@ -8,6 +8,7 @@ See LICENSE for details
 
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from rohmu.common.models import StorageOperation
 from rohmu.common.statsd import StatsdConfig
@@ -23,22 +24,46 @@ from rohmu.object_storage.base import (
     ProgressProportionCallbackType,
     SourceStorageModelT,
 )
-from rohmu.object_storage.config import LOCAL_CHUNK_SIZE as CHUNK_SIZE, LocalObjectStorageConfig as Config
+from rohmu.object_storage.config import (
+    calculate_local_hash_algorithm,
+    LOCAL_CHUNK_SIZE as CHUNK_SIZE,
+    LocalHashAlgorithm,
+    LocalObjectStorageConfig as Config,
+)
 from rohmu.typing import Metadata
-from rohmu.util import BinaryStreamsConcatenation, ProgressStream
-from typing import Any, BinaryIO, Collection, Iterator, Optional, TextIO, Tuple, Union
+from typing import Any, BinaryIO, Callable, Collection, Iterator, Optional, Tuple, Union
 
 import contextlib
 import datetime
+import errno
+import fcntl
 import hashlib
+import io
 import json
 import os
 import shutil
+import sys
 import tempfile
 import uuid
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
 INTERNAL_METADATA_KEY_HASH = "_hash"
-INTERNAL_METADATA_KEYS = {INTERNAL_METADATA_KEY_HASH}
+# only written for non-default algorithms, older versions of rohmu don't filter it out of the metadata they return,
+# a missing key means the hash is sha256
+INTERNAL_METADATA_KEY_HASH_ALGORITHM = "_hash_algorithm"
+INTERNAL_METADATA_KEYS = {INTERNAL_METADATA_KEY_HASH, INTERNAL_METADATA_KEY_HASH_ALGORITHM}
+METADATA_BUFFER_SIZE = 64 * 1024
+KERNEL_COPY_DESTINATION_TYPES = (io.BufferedWriter, io.FileIO)
+HASHLIB_NAMES = {
+    LocalHashAlgorithm.sha256: "sha256",
+    LocalHashAlgorithm.sha512_256: "sha512_256",
+}
+TREE_HASH_BLOCK_SIZE = 1024 * 1024
+UNSUPPORTED_OPERATION_ERRNOS = {errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV}
 
 
 class LocalTransfer(BaseTransfer[Config]):
@@ -53,9 +78,13 @@ class LocalTransfer(BaseTransfer[Config]):
         prefix: Optional[str] = None,
         notifier: Optional[Notifier] = None,
         statsd_info: Optional[StatsdConfig] = None,
+        hash_algorithm: LocalHashAlgorithm = LocalHashAlgorithm.sha256,
     ) -> None:
         prefix = os.path.join(directory, (prefix or "").strip("/"))
         super().__init__(prefix=prefix, notifier=notifier, statsd_info=statsd_info)
+        self.hash_algorithm = LocalHashAlgorithm(hash_algorithm)
+        if self.hash_algorithm == LocalHashAlgorithm.auto:
+            self.hash_algorithm = calculate_local_hash_algorithm()
         self.log.debug("LocalTransfer initialized")
 
     def copy_file(
@@ -95,8 +124,8 @@ class LocalTransfer(BaseTransfer[Config]):
             raise FileNotFoundFromStorageError(key)
         metadata_path = source_path + ".metadata"
         try:
-            with open(metadata_path, "r", encoding="utf-8") as fp:
-                return json.load(fp)
+            with open(metadata_path, "rb") as fp:
+                return load_metadata(fp.read())
         except FileNotFoundError:
             raise FileNotFoundFromStorageError(key)
 
@@ -135,12 +164,14 @@ class LocalTransfer(BaseTransfer[Config]):
     def _skip_file_name(file_name: str) -> bool:
         return file_name.startswith(".") or file_name.endswith(".metadata") or ".metadata_tmp" in file_name
 
-    def _yield_object(self, key: str, full_path: str, with_metadata: bool) -> Iterator[IterKeyItem]:
+    def _yield_object(
+        self, key: str, full_path: str, with_metadata: bool, metadata_buffer: bytearray
+    ) -> Iterator[IterKeyItem]:
         try:
-            metadata = self._get_metadata_for_key(key)
-        except FileNotFoundFromStorageError:
+            metadata = read_metadata_file(full_path + ".metadata", metadata_buffer)
+            st = os.stat(full_path)
+        except FileNotFoundError:
             return
-        st = os.stat(full_path)
         last_modified = datetime.datetime.fromtimestamp(st.st_mtime, tz=datetime.timezone.utc)
         md5 = metadata.get(INTERNAL_METADATA_KEY_HASH)
         yield IterKeyItem(
@@ -156,6 +187,15 @@ class LocalTransfer(BaseTransfer[Config]):
 
     def iter_key(
         self, key: str, *, with_metadata: bool = True, deep: bool = False, include_key: bool = False
+    ) -> Iterator[IterKeyItem]:
+        # reused for reading all the metadata files of the listing
+        metadata_buffer = bytearray(METADATA_BUFFER_SIZE)
+        yield from self._iter_key(
+            key, with_metadata=with_metadata, deep=deep, include_key=include_key, metadata_buffer=metadata_buffer
+        )
+
+    def _iter_key(
+        self, key: str, *, with_metadata: bool, deep: bool, include_key: bool, metadata_buffer: bytearray
     ) -> Iterator[IterKeyItem]:
         target_path = self.format_key_for_backend(key.strip("/"))
         try:
@@ -167,7 +207,9 @@ class LocalTransfer(BaseTransfer[Config]):
                 file_name = os.path.basename(target_path)
                 if self._skip_file_name(file_name):
                     return
-                yield from self._yield_object(key.strip("/"), target_path, with_metadata=with_metadata)
+                yield from self._yield_object(
+                    key.strip("/"), target_path, with_metadata=with_metadata, metadata_buffer=metadata_buffer
+                )
             return
 
         for file_name in input_files:
@@ -177,7 +219,9 @@ class LocalTransfer(BaseTransfer[Config]):
             if os.path.isdir(full_path):
                 file_key = os.path.join(key.strip("/"), file_name)
                 if deep:
-                    yield from self.iter_key(file_key, with_metadata=with_metadata, deep=True)
+                    yield from self._iter_key(
+                        file_key, with_metadata=with_metadata, deep=True, include_key=False, metadata_buffer=metadata_buffer
+                    )
                 else:
                     yield IterKeyItem(type=KEY_TYPE_PREFIX, value=file_key)
             else:
@@ -185,6 +229,7 @@ class LocalTransfer(BaseTransfer[Config]):
                     key=os.path.join(key.strip("/"), file_name),
                     full_path=full_path,
                     with_metadata=with_metadata,
+                    metadata_buffer=metadata_buffer,
                 )
 
     def get_contents_to_fileobj(
@@ -197,24 +242,17 @@ class LocalTransfer(BaseTransfer[Config]):
     ) -> Metadata:
         self._validate_byte_range(byte_range)
         source_path = self.format_key_for_backend(key.strip("/"))
-        if not os.path.exists(source_path):
+        try:
+            fd = os.open(source_path, os.O_RDONLY)
+        except FileNotFoundError:
             raise FileNotFoundFromStorageError(key)
 
-        input_size = os.stat(source_path).st_size
-        bytes_written = 0
-        with open(source_path, "rb") as fp:
-            if byte_range:
-                fp.seek(byte_range[0])
-                input_size = byte_range[1] - byte_range[0] + 1
-            while bytes_written <= input_size:
-                left = min(input_size - bytes_written, CHUNK_SIZE)
-                buf = fp.read(left)
-                if not buf:
-                    break
-                fileobj_to_store_to.write(buf)
-                bytes_written += len(buf)
-                if progress_callback:
-                    progress_callback(bytes_written, input_size)
+        try:
+            file_size = os.fstat(fd).st_size
+            offset, end = (byte_range[0], min(byte_range[1] + 1, file_size)) if byte_range else (0, file_size)
+            copy_to_fileobj(fd, offset, max(end - offset, 0), fileobj_to_store_to, progress_callback)
+        finally:
+            os.close(fd)
 
         return self.get_metadata_for_key(key)
 
@@ -226,8 +264,8 @@ class LocalTransfer(BaseTransfer[Config]):
 
     def _save_metadata(self, target_path: str, metadata: Optional[Metadata]) -> None:
         metadata_path = target_path + ".metadata"
-        with atomic_create_file(metadata_path) as fp:
-            json.dump(self.sanitize_metadata(metadata), fp)
+        with atomic_create_file_binary(metadata_path, suffix=".metadata_tmp") as fp:
+            fp.write(dump_metadata(self.sanitize_metadata(metadata)))
 
     def store_file_object(
         self,
@@ -243,19 +281,30 @@ class LocalTransfer(BaseTransfer[Config]):
         target_path = self.format_key_for_backend(key.strip("/"))
         os.makedirs(os.path.dirname(target_path), exist_ok=True)
         bytes_written = 0
-        m = hashlib.sha256()
+        # plain hashes can be calculated while writing, tree hashes need the complete file
+        hash_name = HASHLIB_NAMES.get(self.hash_algorithm)
+        m = hashlib.new(hash_name) if hash_name is not None else None
         with open(target_path, "wb") as output_fp:
             while True:
                 data = fd.read(1024 * 1024)
                 if not data:
                     break
-                m.update(data)
+                if m is not None:
+                    m.update(data)
                 output_fp.write(data)
                 bytes_written += len(data)
                 if upload_progress_fn:
                     upload_progress_fn(bytes_written)
+        file_hash = m.hexdigest() if m is not None else compute_file_hash(target_path, self.hash_algorithm)
+        self._save_object_metadata(key, target_path, metadata, file_hash)
+
+    def _save_object_metadata(self, key: str, target_path: str, metadata: Optional[Metadata], file_hash: str) -> None:
         metadata = metadata.copy() if metadata is not None else {}
-        metadata[INTERNAL_METADATA_KEY_HASH] = m.hexdigest()
+        metadata[INTERNAL_METADATA_KEY_HASH] = file_hash
+        if self.hash_algorithm == LocalHashAlgorithm.sha256:
+            metadata.pop(INTERNAL_METADATA_KEY_HASH_ALGORITHM, None)
+        else:
+            metadata[INTERNAL_METADATA_KEY_HASH_ALGORITHM] = self.hash_algorithm.value
         self._save_metadata(target_path, metadata)
         self.notifier.object_created(
             key=key, size=os.path.getsize(target_path), metadata=self.sanitize_metadata(self._filter_metadata(metadata))
@@ -282,16 +331,22 @@ class LocalTransfer(BaseTransfer[Config]):
         self,
         upload: ConcurrentUpload,
         chunk_number: int,
-        fd: BinaryIO,
+        fd: Union[BinaryIO, bytes, bytearray, memoryview],
         upload_progress_fn: IncrementalProgressCallbackType = None,
     ) -> None:
         chunks_dir = self._get_chunks_dir(upload)
         try:
             with atomic_create_file_binary(os.path.join(chunks_dir, str(chunk_number))) as chunk_fp:
-                wrapped_fd = ProgressStream(fd)
-                for data in iter(lambda: wrapped_fd.read(CHUNK_SIZE), b""):
-                    chunk_fp.write(data)
-                bytes_read = wrapped_fd.bytes_read
+                if isinstance(fd, (bytes, bytearray, memoryview)):
+                    # in-memory chunks are written as is, without copying them through a stream first
+                    bytes_read = chunk_fp.write(fd)
+                else:
+                    bytes_read = 0
+                    while True:
+                        data = fd.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        bytes_read += chunk_fp.write(data)
             if upload_progress_fn:
                 upload_progress_fn(bytes_read)
             self.stats.operation(StorageOperation.store_file, size=bytes_read)
@@ -303,23 +358,20 @@ class LocalTransfer(BaseTransfer[Config]):
 
     def complete_concurrent_upload(self, upload: ConcurrentUpload) -> None:
         chunks_dir = self._get_chunks_dir(upload)
+        target_path = self.format_key_for_backend(upload.key.strip("/"))
         try:
-            chunk_filenames = sorted(
-                (str(chunk_number) for chunk_number in upload.chunks_to_etags),
-                key=int,
-            )
-            chunk_files = (
-                open(os.path.join(chunks_dir, chunk_file), "rb")  # pylint: disable=consider-using-with
-                for chunk_file in chunk_filenames
-            )
-            stream = BinaryStreamsConcatenation(chunk_files)
+            chunk_paths = [os.path.join(chunks_dir, str(chunk_number)) for chunk_number in sorted(upload.chunks_to_etags)]
+            total_size = sum(os.path.getsize(chunk_path) for chunk_path in chunk_paths)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            with open(target_path, "wb") as output_fp:
+                preallocate_file(output_fp, total_size)
+                for chunk_path in chunk_paths:
+                    with open(chunk_path, "rb") as chunk_fp:
+                        append_file_contents(chunk_fp, output_fp)
+            file_hash = compute_file_hash(target_path, self.hash_algorithm)
         except OSError as ex:
             raise ConcurrentUploadError(f"Failed to complete multipart upload for {upload.key}") from ex
-        self.store_file_object(
-            upload.key,
-            stream,  # type: ignore[arg-type]
-            metadata=upload.metadata,
-        )
+        self._save_object_metadata(upload.key, target_path, upload.metadata, file_hash)
         try:
             shutil.rmtree(chunks_dir)
         except OSError:
@@ -336,27 +388,171 @@ class LocalTransfer(BaseTransfer[Config]):
         return self.format_key_for_backend(".concurrent_upload_" + upload.backend_id)
 
 
-@contextlib.contextmanager
-def atomic_create_file(file_path: str) -> Iterator[TextIO]:
-    """Open a temporary file for writing, rename to final name when done"""
-    fd, tmp_file_path = tempfile.mkstemp(
-        prefix=os.path.basename(file_path), dir=os.path.dirname(file_path), suffix=".metadata_tmp"
-    )
+def copy_to_fileobj(
+    source_fd: int,
+    offset: int,
+    size: int,
+    fileobj: BinaryIO,
+    progress_callback: ProgressProportionCallbackType = None,
+) -> None:
+    """Copy size bytes starting at offset of source_fd to fileobj, without going through Python objects if possible"""
+    # plain files are written directly by the kernel, other file objects (e.g. the ones in rohmu.filewrap) could
+    # transform the data and must go through write(), sendfile() only writes to files on Linux
+    use_sendfile = sys.platform == "linux" and type(fileobj) in KERNEL_COPY_DESTINATION_TYPES
+    output_fd = fileobj.fileno() if use_sendfile else None
+    # sendfile() fails for descriptors opened with O_APPEND, whatever the mode of the Python file object is, and
+    # could stop half way through on non-blocking ones (e.g. sockets with a timeout)
+    if output_fd is not None and fcntl.fcntl(output_fd, fcntl.F_GETFL) & (os.O_APPEND | os.O_NONBLOCK):
+        output_fd = None
+    # in-memory buffers copy what is written to them, so we can keep reusing the same read buffer,
+    # preadv() is not available everywhere (e.g. macOS before Python 3.10)
+    use_read_buffer = type(fileobj) is io.BytesIO and hasattr(os, "preadv")
+    read_buffer = bytearray(min(size, CHUNK_SIZE)) if use_read_buffer else None
+    if output_fd is not None:
+        fileobj.flush()
+    bytes_written = 0
+    while bytes_written < size:
+        count = min(size - bytes_written, CHUNK_SIZE)
+        if output_fd is not None:
+            try:
+                copied = os.sendfile(output_fd, source_fd, offset + bytes_written, count)
+            except OSError as ex:
+                # the kernel can't copy to this descriptor, write() can as long as nothing was copied yet
+                if ex.errno not in {errno.EINVAL, errno.EAGAIN} or bytes_written:
+                    raise
+                output_fd = None
+                continue
+        elif read_buffer is not None:
+            with memoryview(read_buffer) as view:
+                copied = os.preadv(source_fd, [view[:count]], offset + bytes_written)
+                fileobj.write(view[:copied])
+        else:
+            data = os.pread(source_fd, count, offset + bytes_written)
+            fileobj.write(data)
+            copied = len(data)
+        if not copied:
+            break
+        bytes_written += copied
+        if progress_callback:
+            progress_callback(bytes_written, size)
+
+
+def preallocate_file(fp: BinaryIO, size: int) -> None:
+    """Allocate the disk space for the file upfront in one go, if the platform and file system support it"""
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return
     try:
-        with os.fdopen(fd, "w") as out_file:
-            yield out_file
+        os.posix_fallocate(fp.fileno(), 0, size)
+    except OSError as ex:
+        # running out of space is a real error, the file system not supporting preallocation is not
+        if ex.errno not in UNSUPPORTED_OPERATION_ERRNOS:
+            raise
+
+
+def append_file_contents(source_fp: BinaryIO, destination_fp: BinaryIO) -> None:
+    """Copy the rest of the source file to the destination file, in-kernel when the platform allows it"""
+    destination_fp.flush()
+    source_fd = source_fp.fileno()
+    destination_fd = destination_fp.fileno()
+    start = os.lseek(source_fd, 0, os.SEEK_CUR)
+    copy_functions: list[Callable[[int, int, int], int]] = []
+    if hasattr(os, "copy_file_range"):
+        copy_functions.append(os.copy_file_range)
+    # elsewhere sendfile() needs an explicit offset and can only write to sockets
+    if sys.platform == "linux" and hasattr(os, "sendfile"):
+        copy_functions.append(lambda src_fd, dst_fd, count: os.sendfile(dst_fd, src_fd, None, count))
+    for copy_function in copy_functions:
+        try:
+            remaining = os.fstat(source_fd).st_size - start
+            # copies may be short, zero means the end of the source file was reached
+            while remaining > 0:
+                copied = copy_function(source_fd, destination_fd, remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            return
+        except OSError as ex:
+            # the kernel or file system can't copy between these files, try the next method unless we
+            # already copied something
+            if ex.errno not in UNSUPPORTED_OPERATION_ERRNOS or os.lseek(source_fd, 0, os.SEEK_CUR) != start:
+                raise
+    for data in iter(lambda: source_fp.read(CHUNK_SIZE), b""):
+        destination_fp.write(data)
 
-        os.rename(tmp_file_path, file_path)
-    except Exception:  # pytest: disable=broad-except
-        with contextlib.suppress(Exception):
-            os.unlink(tmp_file_path)
-        raise
+
+def dump_metadata(metadata: dict[str, str]) -> bytes:
+    """Serialize metadata to JSON, using orjson when it is available"""
+    if orjson is not None:
+        return orjson.dumps(metadata)
+    return json.dumps(metadata).encode("utf-8")
+
+
+def load_metadata(data: Union[bytes, memoryview]) -> Metadata:
+    """Deserialize metadata written by dump_metadata() or older versions of rohmu"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(bytes(data))
+
+
+def read_metadata_file(metadata_path: str, buffer: bytearray) -> Metadata:
+    """Load a metadata file through the given buffer, the buffer is grown if the file does not fit"""
+    fd = os.open(metadata_path, os.O_RDONLY)
+    try:
+        file_size = os.fstat(fd).st_size
+        if file_size > len(buffer):
+            buffer.extend(bytes(file_size - len(buffer)))
+        with memoryview(buffer) as view:
+            bytes_read = os.readv(fd, [view[:file_size]])
+            with view[:bytes_read] as data:
+                return load_metadata(data)
+    finally:
+        os.close(fd)
+
+
+def file_hexdigest(file_path: str, hash_name: str) -> str:
+    """Return the hex encoded digest of the file contents using the named hashlib algorithm"""
+    m = hashlib.new(hash_name)
+    # read through one reused buffer, the file is not mapped because a concurrent store of the same key truncates
+    # it and accessing a truncated mapping kills the process with SIGBUS
+    buffer = bytearray(CHUNK_SIZE)
+    with open(file_path, "rb", buffering=0) as fp, memoryview(buffer) as view:
+        while True:
+            bytes_read = fp.readinto(view)
+            if not bytes_read:
+                break
+            with view[:bytes_read] as data:
+                m.update(data)
+    return m.hexdigest()
+
+
+def file_sha256_tree(file_path: str, block_size: int = TREE_HASH_BLOCK_SIZE) -> str:
+    """Return the hex encoded SHA-256 of the concatenated SHA-256 digests of each block of the file.
+
+    hashlib and os.pread() release the GIL, so the blocks are read and hashed in parallel threads."""
+    with open(file_path, "rb", buffering=0) as fp:
+        fd = fp.fileno()
+        file_size = os.fstat(fd).st_size
+        if file_size == 0:
+            return hashlib.sha256().hexdigest()
+
+        def hash_block(offset: int) -> bytes:
+            return hashlib.sha256(os.pread(fd, block_size, offset)).digest()
+
+        offsets = range(0, file_size, block_size)
+        with ThreadPoolExecutor(max_workers=min(len(offsets), os.cpu_count() or 1)) as pool:
+            return hashlib.sha256(b"".join(pool.map(hash_block, offsets))).hexdigest()
+
+
+def compute_file_hash(file_path: str, hash_algorithm: LocalHashAlgorithm) -> str:
+    if hash_algorithm == LocalHashAlgorithm.sha256_tree_1m:
+        return file_sha256_tree(file_path, block_size=TREE_HASH_BLOCK_SIZE)
+    return file_hexdigest(file_path, HASHLIB_NAMES[hash_algorithm])
 
 
 @contextlib.contextmanager
-def atomic_create_file_binary(file_path: str) -> Iterator[BinaryIO]:
+def atomic_create_file_binary(file_path: str, suffix: str = "") -> Iterator[BinaryIO]:
     """Open a temporary file for writing, rename to final name when done"""
-    fd, tmp_file_path = tempfile.mkstemp(prefix=os.path.basename(file_path), dir=os.path.dirname(file_path))
+    fd, tmp_file_path = tempfile.mkstemp(prefix=os.path.basename(file_path), dir=os.path.dirname(file_path), suffix=suffix)
     try:
         with os.fdopen(fd, "wb") as out_file:
             yield out_file
@@ -1,23 +1,54 @@
 """Copyright (c) 2022 Aiven, Helsinki, Finland. https://aiven.io/"""
+from __future__ import annotations
+
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from io import BytesIO
 from itertools import cycle
+from pathlib import Path
 from rohmu.errors import FileNotFoundFromStorageError, InvalidByteRangeError
+from rohmu.notifier.interface import Notifier
+from rohmu.object_storage import config, local
 from rohmu.object_storage.base import KEY_TYPE_OBJECT
-from rohmu.object_storage.local import LocalTransfer
+from rohmu.object_storage.config import calculate_local_hash_algorithm, LocalHashAlgorithm
+from rohmu.object_storage.local import (
+    append_file_contents,
+    compute_file_hash,
+    file_hexdigest,
+    file_sha256_tree,
+    LocalTransfer,
+    read_metadata_file,
+)
 from tempfile import NamedTemporaryFile, TemporaryDirectory
-from unittest.mock import MagicMock
+from typing import Any, Literal, Optional
 
+import errno
 import hashlib
 import json
 import os
 import pytest
+import sys
+
+
+class _RecordingNotifier(Notifier):
+    """Cheaper than a MagicMock, records the notifications in the order they were received"""
+
+    def __init__(self) -> None:
+        self.calls: list[tuple[str, dict[str, Any]]] = []
+
+    def object_created(self, key: str, size: Optional[int], metadata: Optional[dict[str, str]]) -> None:
+        self.calls.append(("object_created", {"key": key, "size": size, "metadata": metadata}))
+
+    def object_deleted(self, key: str) -> None:
+        self.calls.append(("object_deleted", {"key": key}))
+
+    def tree_deleted(self, key: str) -> None:
+        self.calls.append(("tree_deleted", {"key": key}))
 
 
 def test_store_file_from_disk() -> None:
     with TemporaryDirectory() as destdir:
-        notifier = MagicMock()
+        notifier = _RecordingNotifier()
         transfer = LocalTransfer(
             directory=destdir,
             notifier=notifier,
@@ -25,19 +56,19 @@ def test_store_file_from_disk() -> None:
         test_data = b"test-data"
         with NamedTemporaryFile() as tmpfile:
             tmpfile.write(test_data)
+            # store_file_from_disk() reopens the file by name, buffered data would not be seen without flushing
             tmpfile.flush()
             transfer.store_file_from_disk(key="test_key1", filepath=tmpfile.name)
 
-        with open(os.path.join(destdir, "test_key1"), "rb") as key1_file_handler:
-            assert key1_file_handler.read() == test_data
-        notifier.object_created.assert_called_once_with(
-            key="test_key1", size=len(test_data), metadata={"Content-Length": "9"}
-        )
+        assert Path(destdir, "test_key1").read_bytes() == test_data
+        assert notifier.calls == [
+            ("object_created", {"key": "test_key1", "size": len(test_data), "metadata": {"Content-Length": "9"}})
+        ]
 
 
 def test_store_file_object() -> None:
     with TemporaryDirectory() as destdir:
-        notifier = MagicMock()
+        notifier = _RecordingNotifier()
         transfer = LocalTransfer(
             directory=destdir,
             notifier=notifier,
@@ -47,10 +78,11 @@ def test_store_file_object() -> None:
 
         transfer.store_file_object(key="test_key2", fd=file_object)
 
-        with open(os.path.join(destdir, "test_key2"), "rb") as key2_file_handler:
-            assert key2_file_handler.read() == test_data
-        notifier.object_created.assert_called_once_with(key="test_key2", size=len(test_data), metadata={})
+        assert Path(destdir, "test_key2").read_bytes() == test_data
+        assert notifier.calls == [("object_created", {"key": "test_key2", "size": len(test_data), "metadata": {}})]
 
+        # get_contents_to_string() reads into a BytesIO, which goes through the reused preadv() buffer,
+        # writing to plain files through sendfile() is covered by test_get_contents_to_fileobj_writes_to_files
         data, _ = transfer.get_contents_to_string("test_key2")
         assert data == test_data
 
@@ -61,9 +93,87 @@ def test_store_file_object() -> None:
         assert data == test_data[:-1]
 
 
-def test_get_contents_to_fileobj_raises_error_on_invalid_byte_range() -> None:
+def test_get_contents_to_string_without_preadv(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.delattr(os, "preadv", raising=False)
+    with TemporaryDirectory() as destdir:
+        transfer = LocalTransfer(directory=destdir)
+        test_data = b"test-data" * 300_000
+        transfer.store_file_from_memory("test_key1", test_data)
+
+        data, _ = transfer.get_contents_to_string("test_key1")
+        assert data == test_data
+
+        data, _ = transfer.get_contents_to_string("test_key1", byte_range=(1, 123456))
+        assert data == test_data[1:123457]
+
+
+def test_get_contents_to_fileobj_reports_progress() -> None:
+    with TemporaryDirectory() as destdir:
+        transfer = LocalTransfer(directory=destdir)
+        test_data = b"test-data" * 300_000
+        transfer.store_file_from_memory("test_key1", test_data)
+        progress: list[tuple[int, int]] = []
+        with BytesIO() as buf:
+            transfer.get_contents_to_fileobj(
+                "test_key1",
+                buf,
+                byte_range=(10, len(test_data) * 2),
+                progress_callback=lambda done, total: progress.append((done, total)),
+            )
+            assert buf.getvalue() == test_data[10:]
+        expected_size = len(test_data) - 10
+        assert progress == [(1024 * 1024, expected_size), (2 * 1024 * 1024, expected_size), (expected_size, expected_size)]
+
+
+# "wb" files are written with sendfile(), append mode and read-write files fall back to pread()
+@pytest.mark.parametrize("mode", ["wb", "ab", "w+b"])
+def test_get_contents_to_fileobj_writes_to_files(mode: Literal["wb", "ab", "w+b"]) -> None:
     with TemporaryDirectory() as destdir:
-        notifier = MagicMock()
+        transfer = LocalTransfer(directory=destdir)
+        test_data = b"test-data" * 300_000
+        transfer.store_file_from_memory("test_key1", test_data)
+        target_path = os.path.join(destdir, "target")
+        with open(target_path, mode) as target_fp:
+            target_fp.write(b"before-")
+            transfer.get_contents_to_fileobj("test_key1", target_fp, byte_range=(5, len(test_data) - 6))
+            assert target_fp.tell() == len(b"before-") + len(test_data) - 10
+            target_fp.write(b"-after")
+        assert Path(target_path).read_bytes() == b"before-" + test_data[5:-5] + b"-after"
+
+
+def test_get_contents_to_fileobj_writes_to_append_only_descriptors() -> None:
+    with TemporaryDirectory() as destdir:
+        transfer = LocalTransfer(directory=destdir)
+        test_data = b"test-data" * 300_000
+        transfer.store_file_from_memory("test_key1", test_data)
+        target_path = os.path.join(destdir, "target")
+        Path(target_path).write_bytes(b"before-")
+        # the descriptor appends even though the file object was opened with "wb"
+        with os.fdopen(os.open(target_path, os.O_WRONLY | os.O_APPEND), "wb") as target_fp:
+            transfer.get_contents_to_fileobj("test_key1", target_fp)
+        assert Path(target_path).read_bytes() == b"before-" + test_data
+
+
+@pytest.mark.parametrize("sendfile_errno", [errno.EINVAL, errno.EAGAIN])
+def test_get_contents_to_fileobj_falls_back_to_write(monkeypatch: pytest.MonkeyPatch, sendfile_errno: int) -> None:
+    def failing_sendfile(out_fd: int, in_fd: int, offset: Optional[int], count: int) -> int:
+        raise OSError(sendfile_errno, os.strerror(sendfile_errno))
+
+    monkeypatch.setattr(os, "sendfile", failing_sendfile)
+    with TemporaryDirectory() as destdir:
+        transfer = LocalTransfer(directory=destdir)
+        test_data = b"test-data" * 300_000
+        transfer.store_file_from_memory("test_key1", test_data)
+        target_path = os.path.join(destdir, "target")
+        with open(target_path, "wb") as target_fp:
+            transfer.get_contents_to_fileobj("test_key1", target_fp)
+        assert Path(target_path).read_bytes() == test_data
+
+
+@pytest.mark.parametrize("byte_range", [(100, 10), (-1, 10)])
+def test_get_contents_to_fileobj_raises_error_on_invalid_byte_range(byte_range: tuple[int, int]) -> None:
+    with TemporaryDirectory() as destdir:
+        notifier = _RecordingNotifier()
         transfer = LocalTransfer(
             directory=destdir,
             notifier=notifier,
@@ -72,22 +182,20 @@ def test_get_contents_to_fileobj_raises_error_on_invalid_byte_range() -> None:
             transfer.get_contents_to_fileobj(
                 key="testkey",
                 fileobj_to_store_to=BytesIO(),
-                byte_range=(100, 10),
+                byte_range=byte_range,
             )
 
 
 def test_can_handle_metadata_without_md5() -> None:
     with TemporaryDirectory() as destdir:
-        notifier = MagicMock()
+        notifier = _RecordingNotifier()
         transfer = LocalTransfer(
             directory=destdir,
             notifier=notifier,
         )
         test_data = b"test-data"
-        with NamedTemporaryFile() as tmpfile:
-            tmpfile.write(test_data)
-            tmpfile.flush()
-            transfer.store_file_from_disk(key="test_key1", filepath=tmpfile.name)
+        # only the stored object matters here, the source does not need to be on disk
+        transfer.store_file_from_memory(key="test_key1", memstring=test_data)
 
         # override the metadata file removing the hash.
         # this simulates files stored by older versions of rohmu
@@ -116,7 +224,7 @@ def test_can_handle_metadata_without_md5() -> None:
 
 def test_can_upload_files_concurrently() -> None:
     with TemporaryDirectory() as destdir:
-        notifier = MagicMock()
+        notifier = _RecordingNotifier()
         transfer = LocalTransfer(
             directory=destdir,
             notifier=notifier,
@@ -124,13 +232,13 @@ def test_can_upload_files_concurrently() -> None:
         upload = transfer.create_concurrent_upload(key="test_key1", metadata={"some-key": "some-value"})
         # should end up with b"Hello, World!\nHello, World!"
         expected_data = b"Hello, World!\nHello, World!"
-        transfer.upload_concurrent_chunk(upload, 3, BytesIO(b"Hello"))
-        transfer.upload_concurrent_chunk(upload, 4, BytesIO(b", "))
-        transfer.upload_concurrent_chunk(upload, 1, BytesIO(b"Hello, World!"))
-        transfer.upload_concurrent_chunk(upload, 7, BytesIO(b"!"))
-        transfer.upload_concurrent_chunk(upload, 2, BytesIO(b"\n"))
-        transfer.upload_concurrent_chunk(upload, 6, BytesIO(b"ld"))
-        transfer.upload_concurrent_chunk(upload, 5, BytesIO(b"Wor"))
+        transfer.upload_concurrent_chunk(upload, 3, memoryview(b"Hello"))
+        transfer.upload_concurrent_chunk(upload, 4, memoryview(b", "))
+        transfer.upload_concurrent_chunk(upload, 1, memoryview(b"Hello, World!"))
+        transfer.upload_concurrent_chunk(upload, 7, memoryview(b"!"))
+        transfer.upload_concurrent_chunk(upload, 2, memoryview(b"\n"))
+        transfer.upload_concurrent_chunk(upload, 6, memoryview(b"ld"))
+        transfer.upload_concurrent_chunk(upload, 5, memoryview(b"Wor"))
 
         # we don't see the temporary files created during upload
         assert transfer.list_prefixes(key="/") == []  # pylint: disable=use-implicit-booleaness-not-comparison
@@ -139,6 +247,10 @@ def test_can_upload_files_concurrently() -> None:
 
         transfer.complete_concurrent_upload(upload)
 
+        # only completing the upload creates the object
+        assert notifier.calls == [
+            ("object_created", {"key": "test_key1", "size": len(expected_data), "metadata": {"some-key": "some-value"}})
+        ]
         # we can read the metadata
         assert transfer.get_metadata_for_key("test_key1") == {"some-key": "some-value"}
         # and we can also load the file information iterating over the storage
@@ -147,11 +259,9 @@ def test_can_upload_files_concurrently() -> None:
         result = item.value
         assert isinstance(result, dict)
 
-        hasher = hashlib.sha256()
-        hasher.update(expected_data)
-        md5 = hasher.hexdigest()  # yes, currently we return an "md5" that is really the sha256 of the contents.
+        digest = hashlib.sha256(expected_data).hexdigest()
         expected_value = {
-            "md5": md5,
+            "md5": digest,  # the "md5" of local objects is the sha256 of the contents
             "name": "test_key1",
             "size": len(expected_data),
             "metadata": {"some-key": "some-value"},
@@ -165,7 +275,7 @@ def test_can_upload_files_concurrently() -> None:
 
 def test_can_upload_files_concurrently_with_threads() -> None:
     with TemporaryDirectory() as destdir:
-        notifier = MagicMock()
+        notifier = _RecordingNotifier()
         transfer = LocalTransfer(
             directory=destdir,
             notifier=notifier,
@@ -174,20 +284,22 @@ def test_can_upload_files_concurrently_with_threads() -> None:
         # should end up with b"Hello, World!\nHello, World!"
         expected_data = b"Hello, World!\nHello, World!"
 
-        with ThreadPoolExecutor() as pool:
-            pool.map(
-                partial(transfer.upload_concurrent_chunk, upload),
-                [3, 4, 1, 7, 2, 6, 5],
-                [
-                    BytesIO(b"Hello"),
-                    BytesIO(b", "),
-                    BytesIO(b"Hello, World!"),
-                    BytesIO(b"!"),
-                    BytesIO(b"\n"),
-                    BytesIO(b"ld"),
-                    BytesIO(b"Wor"),
-                ],
-            )
+        # every chunk is a slice of the same buffer, nothing gets copied before being written out
+        payload = memoryview(expected_data)
+        chunk_numbers = [3, 4, 1, 7, 2, 6, 5]
+        chunks = [
+            payload[14:19],
+            payload[19:21],
+            payload[0:13],
+            payload[26:27],
+            payload[13:14],
+            payload[24:26],
+            payload[21:24],
+        ]
+        # there is no point in starting more threads than there are chunks
+        with ThreadPoolExecutor(max_workers=min(len(chunk_numbers), os.cpu_count() or 4)) as pool:
+            # consume the results, otherwise errors raised by the uploads would go unnoticed
+            list(pool.map(partial(transfer.upload_concurrent_chunk, upload), chunk_numbers, chunks))
 
         transfer.complete_concurrent_upload(upload)
 
@@ -199,11 +311,9 @@ def test_can_upload_files_concurrently_with_threads() -> None:
         result = item.value
         assert isinstance(result, dict)
 
-        hasher = hashlib.sha256()
-        hasher.update(expected_data)
-        md5 = hasher.hexdigest()  # yes, currently we return an "md5" that is really the sha256 of the contents.
+        digest = hashlib.sha256(expected_data).hexdigest()
         expected_value = {
-            "md5": md5,
+            "md5": digest,  # the "md5" of local objects is the sha256 of the contents
             "name": "test_key1",
             "size": len(expected_data),
             "metadata": {"some-key": "some-value"},
@@ -213,9 +323,65 @@ def test_can_upload_files_concurrently_with_threads() -> None:
         assert result == expected_value
 
 
+def test_can_complete_concurrent_uploads_in_parallel() -> None:
+    with TemporaryDirectory() as destdir:
+        notifier = _RecordingNotifier()
+        transfer = LocalTransfer(
+            directory=destdir,
+            notifier=notifier,
+        )
+        # big enough for hashlib to release the GIL while hashing
+        contents = {
+            "test_key1": [b"Hello, " * 65536, b"World!" * 65536],
+            "test_key2": [b"Goodbye, " * 65536, b"World!" * 65536],
+        }
+        uploads = []
+        for key, chunks in contents.items():
+            upload = transfer.create_concurrent_upload(key=key, metadata={"some-key": "some-value"})
+            for chunk_number, chunk in enumerate(chunks, start=1):
+                transfer.upload_concurrent_chunk(upload, chunk_number, BytesIO(chunk))
+            uploads.append(upload)
+
+        with ThreadPoolExecutor(max_workers=len(uploads)) as pool:
+            futures = [pool.submit(transfer.complete_concurrent_upload, upload) for upload in uploads]
+            for future in futures:
+                future.result()
+
+        for key, chunks in contents.items():
+            expected_data = b"".join(chunks)
+            data, metadata = transfer.get_contents_to_string(key)
+            assert data == expected_data
+            assert metadata == {"some-key": "some-value"}
+            item = next(transfer.iter_key(key, with_metadata=False, include_key=True))
+            assert isinstance(item.value, dict)
+            assert item.value["md5"] == hashlib.sha256(expected_data).hexdigest()
+
+
+@pytest.mark.parametrize("fallocate_errno", [None, errno.EOPNOTSUPP])
+def test_complete_concurrent_upload_preallocates_target(
+    monkeypatch: pytest.MonkeyPatch, fallocate_errno: Optional[int]
+) -> None:
+    preallocated = []
+
+    def posix_fallocate(fd: int, offset: int, size: int) -> None:
+        preallocated.append((offset, size))
+        if fallocate_errno is not None:
+            raise OSError(fallocate_errno, os.strerror(fallocate_errno))
+
+    monkeypatch.setattr(os, "posix_fallocate", posix_fallocate, raising=False)
+    with TemporaryDirectory() as destdir:
+        transfer = LocalTransfer(directory=destdir)
+        upload = transfer.create_concurrent_upload(key="test_key1")
+        transfer.upload_concurrent_chunk(upload, 2, b"World!")
+        transfer.upload_concurrent_chunk(upload, 1, b"Hello, ")
+        transfer.complete_concurrent_upload(upload)
+        assert preallocated == [(0, 13)]
+        assert transfer.get_contents_to_string("test_key1")[0] == b"Hello, World!"
+
+
 def test_can_upload_files_concurrently_with_threads_using_different_transfer_instances() -> None:
     with TemporaryDirectory() as destdir:
-        notifier = MagicMock()
+        notifier = _RecordingNotifier()
         first_transfer = LocalTransfer(
             directory=destdir,
             notifier=notifier,
@@ -228,16 +394,16 @@ def test_can_upload_files_concurrently_with_threads_using_different_transfer_ins
         # should end up with b"Hello, World!\nHello, World!"
         expected_data = b"Hello, World!\nHello, World!"
 
-        with ThreadPoolExecutor() as pool:
-            data_chunks = [
-                BytesIO(b"Hello"),
-                BytesIO(b", "),
-                BytesIO(b"Hello, World!"),
-                BytesIO(b"!"),
-                BytesIO(b"\n"),
-                BytesIO(b"ld"),
-                BytesIO(b"Wor"),
-            ]
+        data_chunks = [
+            BytesIO(b"Hello"),
+            BytesIO(b", "),
+            BytesIO(b"Hello, World!"),
+            BytesIO(b"!"),
+            BytesIO(b"\n"),
+            BytesIO(b"ld"),
+            BytesIO(b"Wor"),
+        ]
+        with ThreadPoolExecutor(max_workers=min(len(data_chunks), os.cpu_count() or 4)) as pool:
             futures = []
             for i, data, transfer in zip([3, 4, 1, 7, 2, 6, 5], data_chunks, cycle([first_transfer, second_transfer])):
                 futures.append(pool.submit(partial(transfer.upload_concurrent_chunk, upload), i, data))
@@ -253,11 +419,9 @@ def test_can_upload_files_concurrently_with_threads_using_different_transfer_ins
         result = item.value
         assert isinstance(result, dict)
 
-        hasher = hashlib.sha256()
-        hasher.update(expected_data)
-        md5 = hasher.hexdigest()
+        digest = hashlib.sha256(expected_data).hexdigest()
         expected_value = {
-            "md5": md5,
+            "md5": digest,  # the "md5" of local objects is the sha256 of the contents
             "name": "test_key1",
             "size": len(expected_data),
             "metadata": {"some-key": "some-value"},
@@ -269,7 +433,7 @@ def test_can_upload_files_concurrently_with_threads_using_different_transfer_ins
 
 def test_upload_files_concurrently_can_be_aborted() -> None:
     with TemporaryDirectory() as destdir:
-        notifier = MagicMock()
+        notifier = _RecordingNotifier()
         transfer = LocalTransfer(
             directory=destdir,
             notifier=notifier,
@@ -297,3 +461,152 @@ def test_upload_files_concurrently_can_be_aborted() -> None:
         # we should not be able to find this
         with pytest.raises(FileNotFoundFromStorageError):
             transfer.get_metadata_for_key("test_key1")
+
+
+@pytest.mark.parametrize("data", [b"", b"test-data", b"x" * (3 * 1024 * 1024 + 1)])
+@pytest.mark.parametrize("hash_name", ["sha256", "sha512_256"])
+def test_file_hexdigest(data: bytes, hash_name: str) -> None:
+    with NamedTemporaryFile() as tmpfile:
+        tmpfile.write(data)
+        tmpfile.flush()
+        assert file_hexdigest(tmpfile.name, hash_name) == hashlib.new(hash_name, data).hexdigest()
+
+
+@pytest.mark.parametrize(
+    "platform,unsupported,unsupported_errno,missing",
+    [
+        ("linux", (), errno.EXDEV, ()),
+        ("linux", ("copy_file_range",), errno.EXDEV, ()),
+        ("linux", ("copy_file_range", "sendfile"), errno.EXDEV, ()),
+        ("linux", (), errno.EXDEV, ("copy_file_range", "sendfile")),
+        # macOS has no copy_file_range() and its sendfile() fails unless writing to a socket
+        ("darwin", ("sendfile",), errno.ENOTSOCK, ("copy_file_range",)),
+    ],
+)
+def test_append_file_contents(
+    monkeypatch: pytest.MonkeyPatch,
+    platform: str,
+    unsupported: tuple[str, ...],
+    unsupported_errno: int,
+    missing: tuple[str, ...],
+) -> None:
+    def not_supported(*args: Any, **kwargs: Any) -> int:
+        raise OSError(unsupported_errno, os.strerror(unsupported_errno))
+
+    monkeypatch.setattr(sys, "platform", platform)
+    for function_name in unsupported:
+        monkeypatch.setattr(os, function_name, not_supported, raising=False)
+    for function_name in missing:
+        monkeypatch.delattr(os, function_name, raising=False)
+    with TemporaryDirectory() as tmpdir:
+        destination_path = os.path.join(tmpdir, "destination")
+        with open(destination_path, "wb") as destination_fp:
+            destination_fp.write(b"existing-")
+            for number, data in enumerate([b"first-", b"", b"second" * 1024]):
+                source_path = os.path.join(tmpdir, f"source{number}")
+                with open(source_path, "wb") as source_output_fp:
+                    source_output_fp.write(data)
+                with open(source_path, "rb") as source_fp:
+                    append_file_contents(source_fp, destination_fp)
+        with open(destination_path, "rb") as result_fp:
+            assert result_fp.read() == b"existing-first-" + b"second" * 1024
+
+
+@pytest.mark.parametrize("data", [b"", b"test-data", b"x" * (3 * 1024 * 1024 + 1)])
+def test_file_sha256_tree(data: bytes) -> None:
+    block_size = 1024 * 1024
+    block_digests = b"".join(hashlib.sha256(data[i : i + block_size]).digest() for i in range(0, len(data), block_size))
+    with NamedTemporaryFile() as tmpfile:
+        tmpfile.write(data)
+        tmpfile.flush()
+        assert file_sha256_tree(tmpfile.name, block_size=block_size) == hashlib.sha256(block_digests).hexdigest()
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_metadata_round_trip(monkeypatch: pytest.MonkeyPatch, use_orjson: bool) -> None:
+    if use_orjson and local.orjson is None:
+        pytest.skip("orjson is not installed")
+    if not use_orjson:
+        monkeypatch.setattr(local, "orjson", None)
+    with TemporaryDirectory() as destdir:
+        transfer = LocalTransfer(directory=destdir)
+        metadata = {"Content-Length": "9", "some-key": "söme-välue"}
+        transfer.store_file_from_memory("test_key1", b"test-data", metadata=metadata)
+        assert transfer.get_metadata_for_key("test_key1") == metadata
+        # both encoders must produce plain JSON readable by older versions of rohmu
+        with open(transfer.format_key_for_backend("test_key1") + ".metadata", encoding="utf-8") as metadata_fp:
+            stored_metadata = json.load(metadata_fp)
+        assert stored_metadata["some-key"] == "söme-välue"
+        # older versions of rohmu would return the algorithm as user metadata, it is only stored when it isn't sha256
+        assert "_hash_algorithm" not in stored_metadata
+        # no temporary metadata files are left behind
+        assert sorted(os.listdir(destdir)) == ["test_key1", "test_key1.metadata"]
+
+
+def test_read_metadata_file_reuses_buffer() -> None:
+    with TemporaryDirectory() as destdir:
+        transfer = LocalTransfer(directory=destdir)
+        transfer.store_file_from_memory("test_key1", b"test-data", metadata={"some-key": "some-value"})
+        transfer.store_file_from_memory("dir/test_key2", b"test-data", metadata={"other-key": "x" * 1024})
+        buffer = bytearray(16)
+        metadata_path = transfer.format_key_for_backend("dir/test_key2") + ".metadata"
+        assert read_metadata_file(metadata_path, buffer)["other-key"] == "x" * 1024
+        assert len(buffer) == os.path.getsize(metadata_path)
+        metadata_path = transfer.format_key_for_backend("test_key1") + ".metadata"
+        assert read_metadata_file(metadata_path, buffer)["some-key"] == "some-value"
+
+        listed = {item["name"]: item["metadata"] for item in transfer.list_iter("", deep=True)}
+        assert listed == {
+            "test_key1": {"Content-Length": "9", "some-key": "some-value"},
+            "dir/test_key2": {"Content-Length": "9", "other-key": "x" * 1024},
+        }
+
+
+@pytest.mark.parametrize(
+    "cpu_flags,expected",
+    [
+        (frozenset({"fpu", "avx2", "sha_ni"}), LocalHashAlgorithm.sha256),
+        (frozenset({"fp", "asimd", "sha2"}), LocalHashAlgorithm.sha256),
+        (frozenset({"fpu", "avx2"}), LocalHashAlgorithm.sha512_256),
+    ],
+)
+def test_calculate_local_hash_algorithm(
+    monkeypatch: pytest.MonkeyPatch, cpu_flags: frozenset[str], expected: LocalHashAlgorithm
+) -> None:
+    monkeypatch.setattr(config, "get_cpu_flags", lambda: cpu_flags)
+    monkeypatch.setattr(config.platform, "system", lambda: "Linux")
+    calculate_local_hash_algorithm.cache_clear()
+    try:
+        assert calculate_local_hash_algorithm() == expected
+    finally:
+        calculate_local_hash_algorithm.cache_clear()
+
+
+@pytest.mark.parametrize("hash_algorithm", list(LocalHashAlgorithm))
+def test_can_store_files_with_hash_algorithm(hash_algorithm: LocalHashAlgorithm) -> None:
+    with TemporaryDirectory() as destdir:
+        transfer = LocalTransfer(directory=destdir, hash_algorithm=hash_algorithm)
+        assert transfer.hash_algorithm != LocalHashAlgorithm.auto
+        test_data = b"test-data" * 300_000
+        transfer.store_file_object(key="test_key1", fd=BytesIO(test_data))
+        upload = transfer.create_concurrent_upload(key="test_key2")
+        transfer.upload_concurrent_chunk(upload, 1, test_data)
+        transfer.complete_concurrent_upload(upload)
+
+        with NamedTemporaryFile() as tmpfile:
+            tmpfile.write(test_data)
+            tmpfile.flush()
+            if transfer.hash_algorithm == LocalHashAlgorithm.sha256_tree_1m:
+                expected_hash = file_sha256_tree(tmpfile.name)
+            else:
+                expected_hash = hashlib.new(transfer.hash_algorithm.value.replace("-", "_"), test_data).hexdigest()
+            assert compute_file_hash(tmpfile.name, transfer.hash_algorithm) == expected_hash
+
+        expected_metadata = {"_hash": expected_hash}
+        if transfer.hash_algorithm != LocalHashAlgorithm.sha256:
+            expected_metadata["_hash_algorithm"] = transfer.hash_algorithm.value
+        for key in ["test_key1", "test_key2"]:
+            with open(transfer.format_key_for_backend(key) + ".metadata", encoding="utf-8") as metadata_fp:
+                metadata = json.load(metadata_fp)
+            assert metadata == expected_metadata
+            assert transfer.get_metadata_for_key(key) == {}